@@ -1,13 +1,38 @@
 import os
 import sys
+import shutil
 import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
+import random
+import heapq
 from tqdm import tqdm
 import argparse
+import logging
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 import queue
+import collections
+import itertools
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# 最大线程数，对同一服务器并发太多连接会被限流，还会耗尽端口和文件句柄，macOS默认的文件句柄限制更低
+MAX_THREADS = 48 if sys.platform == 'darwin' else 64
+
+def file_name_from_url(url):
+    """从URL中提取文件名，提取不到时返回download.bin"""
+    try:
+        path = urlparse(url).path
+    except ValueError:
+        # 例如方括号不匹配的IPv6地址
+        return 'download.bin'
+    return os.path.basename(path) or 'download.bin'
 
 class MultiThreadDownloader:
     def __init__(self, url, file_name=None, threads=10, chunk_size=1024*1024, save_dir=None, timeout=60):
@@ -15,30 +40,54 @@ class MultiThreadDownloader:
         参数:
             url (str): 下载链接
             file_name (str): 保存的文件名，默认从URL提取
-            threads (int): 线程数，默认为10
-            chunk_size (int): 每个块的大小，默认为1MB
+            threads (int): 线程数，默认为10，超过MAX_THREADS时按MAX_THREADS处理
+            chunk_size (int): 每次写入磁盘的块大小，默认为1MB
             save_dir (str): 保存目录，默认使用当前目录或从file_name中提取
-            timeout (int): 线程超时时间(秒)，默认为60秒
+            timeout (int): 网络超时时间(秒)，超过这个时间收不到数据的任务会重新分配，默认为60秒
         """
         self.url = url
-        self.threads = threads
+        self.threads = max(1, min(threads, MAX_THREADS))
+        if self.threads != threads:
+            logger.warning("线程数 %d 超出范围，已调整为 %d", threads, self.threads)
         self.chunk_size = chunk_size
+        # 每次从网络读取的大小，与chunk_size分开，避免每个线程都缓冲整块数据
+        self.read_size = 64 * 1024
         self.file_size = 0
-        self.lock = threading.Lock()
+        # 服务器是否支持Range请求
+        self.accept_ranges = False
+        # 下载过程中发现服务器忽略了Range请求
+        self.ranges_ignored = False
         self.completed = 0
         self.progress_bar = None
-        self.gui_progress_var = None
+        # GUI进度队列，Tk变量不是线程安全的，由GUI线程从队列中取出进度再更新
+        self.progress_queue = None
         self.timeout = timeout
-        # 任务队列
-        self.task_queue = queue.Queue()
-        # 线程状态跟踪
-        self.thread_status = {}
-        # 任务是否完成标志
+        # 任务列表，元素为(start, end, task_id)
+        self.tasks = []
+        # 每个任务失败后最多重试的次数
+        self.max_retries = 5
+        # 下载结束标志，设置后进度汇总线程和正在进行的任务都会退出
         self.is_completed = False
-        # 线程最后活动时间
-        self.last_activity = {}
-        # 启动超时检测线程
-        self.timeout_thread = None
+        # 每个任务已下载的字节数，只由处理该任务的线程写入，不需要加锁
+        self.task_bytes = {}
+        # 下载线程的缓冲区，线程池中的每个线程一份
+        self.local = threading.local()
+        # 文件超过物理内存的一半时，任务完成后把写入的数据从页缓存中释放
+        self.drop_cache = False
+        # 进度汇总线程
+        self.progress_thread = None
+        # 下载线程的栈大小，线程只阻塞在网络读取上，不需要默认的8MB栈
+        self.worker_stack_size = 512 * 1024
+        # 所有请求共用一个会话，复用keep-alive连接，避免每个分块都重新握手
+        self.session = requests.Session()
+        # 连接池比并发线程数留些余量，连接出错时由urllib3自动重试；
+        # 服务器临时错误由download()按任务退避重试，这里不再重试，以免两层重试次数相乘
+        adapter = HTTPAdapter(pool_connections=self.threads, pool_maxsize=self.threads * 2,
+                              max_retries=Retry(total=3, backoff_factor=0.3))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # 要求服务器不压缩，保证Content-Length和Range都对应文件本身的字节
+        self.session.headers['Accept-Encoding'] = 'identity'
         
         # 处理保存目录和文件名
         if save_dir:
@@ -51,7 +100,7 @@ class MultiThreadDownloader:
                 self.file_name = os.path.join(self.save_dir, os.path.basename(file_name))
             else:
                 # 如果没有提供文件名，从URL提取并放在指定目录下
-                self.file_name = os.path.join(self.save_dir, self._get_file_name_from_url())
+                self.file_name = os.path.join(self.save_dir, file_name_from_url(self.url))
         else:
             if file_name:
                 # 如果提供了文件名，使用它的目录
@@ -60,272 +109,400 @@ class MultiThreadDownloader:
             else:
                 # 如果都没有提供，使用当前目录
                 self.save_dir = os.getcwd()
-                self.file_name = os.path.join(self.save_dir, self._get_file_name_from_url())
+                self.file_name = os.path.join(self.save_dir, file_name_from_url(self.url))
+        # 不含目录的文件名，用于日志和进度条
+        self._basename = os.path.basename(self.file_name)
         
-    def _get_file_name_from_url(self):
-        """从URL中提取文件名"""
-        import re
-        file_name = re.findall(r'[^/]+$', self.url.split('?')[0])[0]
-        return file_name
-    
     def _get_file_size(self):
-        """获取文件大小"""
+        """获取文件大小，并检查服务器是否支持Range请求"""
         try:
-            response = requests.head(self.url, allow_redirects=True)
-            if 'Content-Length' in response.headers:
+            response = self.session.head(self.url, allow_redirects=True, timeout=self.timeout)
+            if response.ok and 'Content-Length' in response.headers:
                 self.file_size = int(response.headers['Content-Length'])
-                return True
-            return False
+                self.accept_ranges = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+                if self.accept_ranges:
+                    return True
+            # 很多CDN对HEAD不返回Content-Length或Accept-Ranges，改用Range请求实际探测一次
+            return self._probe_range() or self.file_size > 0
         except Exception as e:
-            print(f"获取文件大小失败: {e}")
+            logger.warning("获取文件大小失败: %s", e)
+            return False
+    
+    def _probe_range(self):
+        """请求第一个字节，从Content-Range中得到文件大小
+        返回:
+            bool: 服务器是否以206响应了Range请求并给出了文件总大小
+        """
+        headers = {'Range': 'bytes=0-0'}
+        with self.session.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+            # Content-Range格式为 bytes 0-0/文件大小，文件大小未知时为*
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if response.status_code == 206 and total.isdigit():
+                self.file_size = int(total)
+                self.accept_ranges = True
+                return True
+            if response.ok and 'Content-Length' in response.headers and not self.file_size:
+                # 服务器忽略了Range，但至少给出了文件大小
+                self.file_size = int(response.headers['Content-Length'])
             return False
     
-    def _download_chunk(self, thread_id):
-        """从任务队列中获取任务并下载
+    def _download_task(self, start, end, task_id):
+        """下载一个任务对应的区间并写入输出文件，失败时抛出异常，由download()决定是否重试
         参数:
-            thread_id (int): 线程ID
+            start (int): 区间起点
+            end (int): 区间终点（包含）
+            task_id (int): 任务ID
         """
-        # 初始化线程状态
-        with self.lock:
-            self.thread_status[thread_id] = 'running'
-            self.last_activity[thread_id] = time.time()
-            
+        # 下载已经结束（失败或服务器忽略Range），已开始运行的任务也不再发出请求
+        if self.is_completed:
+            return
+        # 重试时从头下载，之前计入进度的字节数清零
+        self.task_bytes[task_id] = 0
+        # 网络数据直接读入这个缓冲区，攒满chunk_size再写入，同一线程处理的所有任务共用，
+        # 避免每次读取都创建新的bytes对象，也减少写入的系统调用次数
+        view = getattr(self.local, 'view', None)
+        if view is None:
+            view = self.local.view = memoryview(bytearray(self.chunk_size))
+        # 每个任务使用自己的文件描述符写入输出文件，互不影响文件偏移
+        fd = os.open(self.file_name, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
         try:
-            while not self.is_completed:
-                try:
-                    # 从队列获取任务，如果队列为空则等待
-                    start, end, task_id = self.task_queue.get(timeout=1)  # 1秒超时，以便定期检查任务完成状态
-                    
-                    with self.lock:
-                        self.last_activity[thread_id] = time.time()
-                        print(f"线程 {thread_id} 开始处理任务 {task_id}: {start}-{end}")
-                    
-                    headers = {'Range': f'bytes={start}-{end}'}
-                    response = requests.get(self.url, headers=headers, stream=True, timeout=self.timeout)
-                    
-                    if response.status_code in [200, 206]:  # 200: 正常, 206: 部分内容
-                        # 在保存目录中创建part文件
-                        part_file_path = os.path.join(self.save_dir, f'{os.path.basename(self.file_name)}.part{task_id}')
-                        with open(part_file_path, 'wb') as f:
-                            for chunk in response.iter_content(chunk_size=self.chunk_size):
-                                if chunk:
-                                    f.write(chunk)
-                                    with self.lock:
-                                        self.completed += len(chunk)
-                                        self.last_activity[thread_id] = time.time()
-                                        if self.progress_bar:
-                                            self.progress_bar.update(len(chunk))
-                                        if self.gui_progress_var:
-                                            percentage = (self.completed / self.file_size) * 100 if self.file_size > 0 else 0
-                                            self.gui_progress_var.set(percentage)
-                    else:
-                        print(f"线程 {thread_id} 任务 {task_id} 下载失败: HTTP {response.status_code}")
-                        # 将失败的任务重新加入队列
-                        with self.lock:
-                            self.task_queue.put((start, end, task_id))
-                    
-                    # 标记任务完成
-                    self.task_queue.task_done()
-                    
-                except queue.Empty:
-                    # 队列为空，检查是否所有任务都已完成
-                    if self.task_queue.empty() and self.completed >= self.file_size and self.file_size > 0:
-                        with self.lock:
-                            self.is_completed = True
+            logger.debug("开始处理任务 %d: %d-%d", task_id, start, end)
+            
+            headers = {'Range': f'bytes={start}-{end}'}
+            # 5秒内连不上或超过timeout秒收不到数据时抛出异常，任务会被重新提交
+            with self.session.get(self.url, headers=headers, stream=True, timeout=(5, self.timeout)) as response:
+                if response.status_code == 200:
+                    # 服务器忽略了Range，返回的是整个文件，继续下载只会让每个任务都重复下载整个文件
+                    logger.warning("任务 %d: 服务器忽略了Range请求，停止多线程下载", task_id)
+                    self.ranges_ignored = True
+                    self.is_completed = True
+                    return
+                if response.status_code != 206:  # 206: 部分内容
+                    raise IOError(f"HTTP {response.status_code}")
+                
+                # 直接写入输出文件中该任务对应的位置
+                offset = start
+                filled = 0
+                response.raw.decode_content = True
+                # 下载结束（失败或服务器忽略Range）时，正在进行的任务也尽快停止
+                while not self.is_completed:
+                    n = response.raw.readinto(view[filled:filled + self.read_size])
+                    if not n:
                         break
-                except Exception as e:
-                    print(f"线程 {thread_id} 发生错误: {e}")
-                    # 如果有任务在处理中，将其重新加入队列
-                    if 'start' in locals() and 'end' in locals() and 'task_id' in locals():
-                        with self.lock:
-                            self.task_queue.put((start, end, task_id))
-                    # 短暂休息后继续尝试
-                    time.sleep(1)
+                    filled += n
+                    if filled == self.chunk_size:
+                        self._write_at(fd, view, offset)
+                        offset += filled
+                        # 每写入一块才更新一次本任务的计数，由进度汇总线程统一刷新进度条
+                        self.task_bytes[task_id] += filled
+                        filled = 0
+                if filled:
+                    self._write_at(fd, view[:filled], offset)
+                    offset += filled
+                    self.task_bytes[task_id] += filled
+                if offset != end + 1:
+                    raise IOError(f"收到的数据不完整: {offset - start}/{end - start + 1} 字节")
+            if self.drop_cache:
+                self._drop_cache(fd, start, end - start + 1)
+        except Exception:
+            self.task_bytes[task_id] = 0
+            raise
         finally:
-            with self.lock:
-                self.thread_status[thread_id] = 'stopped'
+            os.close(fd)
     
-    def _check_timeouts(self):
-        """检查线程超时并重新分配任务"""
-        while not self.is_completed:
-            time.sleep(10)  # 每10秒检查一次
-            current_time = time.time()
-            
-            with self.lock:
-                # 检查哪些线程超时
-                for thread_id, last_time in list(self.last_activity.items()):
-                    if (current_time - last_time > self.timeout and 
-                        self.thread_status.get(thread_id) == 'running'):
-                        print(f"线程 {thread_id} 超时({current_time - last_time:.2f}秒)，将重新分配其任务")
-                        # 将该线程标记为超时
-                        self.thread_status[thread_id] = 'timeout'
-                        # 这里不直接终止线程，而是让其自行结束
-                        # 线程在下次尝试获取任务时会发现状态变化
-        
-    def _merge_parts(self):
-        """合并所有下载的部分"""
-        print(f"正在合并文件到: {self.file_name}")
-        print(f"保存目录: {self.save_dir}")
+    def _drop_cache(self, fd, offset, length):
+        """把已写入的区间刷到磁盘并从页缓存中释放，避免大文件挤掉其他程序的缓存
+        posix_fadvise只会丢弃干净的页，所以要先fdatasync
+        参数:
+            fd (int): 当前任务的输出文件描述符
+            offset (int): 区间起点
+            length (int): 区间长度
+        """
+        if not hasattr(os, 'posix_fadvise'):
+            return
         try:
-            # 确保使用完整路径保存最终文件
-            with open(self.file_name, 'wb') as f:
-                # 查找所有的part文件
-                part_files = []
-                for i in range(self.threads * 2):  # 考虑可能的重新分配任务
-                    part_file_path = os.path.join(self.save_dir, f'{os.path.basename(self.file_name)}.part{i}')
-                    if os.path.exists(part_file_path):
-                        part_files.append((part_file_path, i))
-                
-                # 按任务ID排序后合并
-                for part_file_path, task_id in sorted(part_files, key=lambda x: x[1]):
-                    print(f"读取part文件: {part_file_path}")
-                    with open(part_file_path, 'rb') as pf:
-                        f.write(pf.read())
-                    os.remove(part_file_path)
-                    print(f"已删除: {part_file_path}")
-            print(f"文件 {self.file_name} 下载完成!")
-            return True
-        except Exception as e:
-            print(f"合并文件失败: {str(e)}")
-            print(f"尝试保存到的路径: {self.file_name}")
-            return False
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+        except OSError as e:
+            # 只是缓存优化，失败不影响下载结果
+            logger.debug("释放页缓存失败: %s", e)
+    
+    def _submit_task(self, executor, task):
+        """以较小的线程栈向线程池提交一个下载任务
+        参数:
+            executor (ThreadPoolExecutor): 下载线程池
+            task (tuple): (start, end, task_id)
+        """
+        # stack_size是全局设置，线程池在submit时才创建线程，提交后立即恢复
+        old_stack_size = threading.stack_size(self.worker_stack_size)
+        try:
+            return executor.submit(self._download_task, *task)
+        finally:
+            threading.stack_size(old_stack_size)
     
-    def download(self, gui_progress_var=None):
+    def _report_progress(self):
+        """定期汇总各线程的下载字节数并刷新进度条"""
+        reported = 0
+        while True:
+            finished = self.is_completed
+            self.completed = sum(self.task_bytes.values())
+            if self.progress_bar and self.completed != reported:
+                self.progress_bar.update(self.completed - reported)
+            if self.progress_queue and (self.completed != reported or finished):
+                percentage = (self.completed / self.file_size) * 100 if self.file_size > 0 else 0
+                self.progress_queue.put(percentage)
+            reported = self.completed
+            if finished:
+                break
+            time.sleep(0.1)
+    
+    def _physical_memory(self):
+        """返回物理内存大小（字节），无法获取时返回0"""
+        try:
+            return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            # Windows没有sysconf
+            return 0
+    
+    def _create_output(self):
+        """创建输出文件并按文件大小预分配空间"""
+        fd = os.open(self.file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+        try:
+            if sys.platform == 'win32':
+                self._set_file_length_win32(fd)
+            else:
+                try:
+                    # 一次性分配好磁盘空间，各线程写入时不必再扩展文件
+                    os.posix_fallocate(fd, 0, self.file_size)
+                except (AttributeError, OSError):
+                    # 没有posix_fallocate或文件系统不支持时，至少先把文件设为最终大小
+                    os.ftruncate(fd, self.file_size)
+        finally:
+            os.close(fd)
+    
+    def _set_file_length_win32(self, fd):
+        """在Windows上直接把文件设为最终大小
+        os.ftruncate在Windows上会向扩展出的部分逐块写零，大文件要先写一遍磁盘才能开始下载，
+        SetEndOfFile只修改文件长度并分配空间。NTFS仍会在写入超过有效数据长度的位置时
+        同步补零，这部分开销只是推迟到了首次写入靠后区间的线程中，并没有省掉；
+        SetFileValidData可以跳过补零，但需要管理员权限，且下载失败时文件中会残留磁盘上的旧数据，所以不使用
+        参数:
+            fd (int): 输出文件的文件描述符
+        """
+        import ctypes
+        import msvcrt
+        from ctypes import wintypes
+        
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        kernel32.SetFilePointerEx.argtypes = [wintypes.HANDLE, ctypes.c_longlong,
+                                              ctypes.POINTER(ctypes.c_longlong), wintypes.DWORD]
+        kernel32.SetFilePointerEx.restype = wintypes.BOOL
+        kernel32.SetEndOfFile.argtypes = [wintypes.HANDLE]
+        kernel32.SetEndOfFile.restype = wintypes.BOOL
+        
+        handle = msvcrt.get_osfhandle(fd)
+        if not kernel32.SetFilePointerEx(handle, self.file_size, None, 0) or not kernel32.SetEndOfFile(handle):
+            raise ctypes.WinError(ctypes.get_last_error())
+    
+    def _write_at(self, fd, data, offset):
+        """将数据写入输出文件的指定偏移处
+        参数:
+            fd (int): 当前线程的输出文件描述符
+            data (bytes | bytearray | memoryview): 要写入的数据
+            offset (int): 在输出文件中的偏移
+        """
+        view = memoryview(data)
+        while view:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(fd, view, offset)
+            else:
+                # Windows没有pwrite，文件描述符是线程独占的，直接定位后写入即可
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, view)
+            view = view[written:]
+            offset += written
+    
+    def download(self, progress_queue=None):
         """开始下载文件
         参数:
-            gui_progress_var: GUI进度条变量，用于更新进度
+            progress_queue (queue.Queue): GUI进度队列，下载过程中会放入进度百分比
         """
-        self.gui_progress_var = gui_progress_var
+        self.progress_queue = progress_queue
         self.is_completed = False
         self.completed = 0
         
-        # 清空任务队列
-        while not self.task_queue.empty():
-            try:
-                self.task_queue.get_nowait()
-                self.task_queue.task_done()
-            except queue.Empty:
-                break
-        
-        # 重置线程状态
-        self.thread_status = {}
-        self.last_activity = {}
+        self.ranges_ignored = False
         
         # 检查是否支持断点续传
         if not self._get_file_size():  # 如果无法获取文件大小
-            print("无法获取文件大小，尝试单线程下载...")
-            result = self._single_thread_download()
-            if self.gui_progress_var:
-                self.gui_progress_var.set(100)
-            return result
+            return self._fallback_to_single_thread("无法获取文件大小")
+        if not self.accept_ranges:
+            return self._fallback_to_single_thread("服务器不支持断点续传")
         
         # 计算每个任务的大小（比线程数多一些任务，以便更好地处理超时）
         task_size = self.file_size // (self.threads * 2)  # 每个任务的大小
         if task_size == 0:
             task_size = 1  # 确保任务大小至少为1
         
-        # 创建任务队列
-        task_id = 0
-        current_position = 0
-        while current_position < self.file_size:
-            start = current_position
-            end = min(current_position + task_size - 1, self.file_size - 1)
-            self.task_queue.put((start, end, task_id))
-            current_position = end + 1
-            task_id += 1
-        
-        print(f"文件名: {os.path.basename(self.file_name)}")
-        print(f"保存目录: {self.save_dir}")
-        print(f"文件大小: {self.file_size / (1024*1024):.2f} MB")
-        print(f"线程数: {self.threads}")
-        print(f"任务数: {task_id}")
-        print(f"超时设置: {self.timeout}秒")
+        # 创建任务列表，起点、终点和ID都由range给出，整个列表一次性生成
+        task_starts = range(0, self.file_size, task_size)
+        task_ends = itertools.chain(range(task_size - 1, self.file_size - 1, task_size), [self.file_size - 1])
+        self.tasks = list(zip(task_starts, task_ends, range(len(task_starts))))
+        # 先登记所有任务，进度汇总线程求和时字典不会改变大小
+        self.task_bytes = dict.fromkeys(range(len(self.tasks)), 0)
+        memory = self._physical_memory()
+        self.drop_cache = 0 < memory // 2 < self.file_size
+        
+        logger.info("文件名: %s", self._basename)
+        logger.info("保存目录: %s", self.save_dir)
+        logger.info("文件大小: %.2f MB", self.file_size / (1024*1024))
+        logger.info("线程数: %d", self.threads)
+        logger.info("任务数: %d", len(task_starts))
+        logger.info("超时设置: %s秒", self.timeout)
         
         # 创建进度条
-        if not self.gui_progress_var:
-            self.progress_bar = tqdm(total=self.file_size, unit='B', unit_scale=True, desc=os.path.basename(self.file_name))
-        
-        # 创建并启动超时检测线程
-        self.timeout_thread = threading.Thread(target=self._check_timeouts, daemon=True)
-        self.timeout_thread.start()
-        
-        # 创建线程列表
-        threads = []
+        if not self.progress_queue:
+            # 进度条只由进度汇总线程更新，限制刷新频率，刷新时不阻塞等待tqdm的锁；
+            # 终端宽度变化时自动调整，大小按1024换算，与日志中的MB一致
+            self.progress_bar = tqdm(total=self.file_size, unit='B', unit_scale=True, unit_divisor=1024,
+                                     desc=self._basename, mininterval=0.2,
+                                     lock_args=(False,), dynamic_ncols=True)
+        
+        # 预先创建好输出文件，各线程直接写入自己负责的区间，无需再合并
+        self._create_output()
+        
+        # 创建并启动进度汇总线程
+        self.progress_thread = threading.Thread(target=self._report_progress, daemon=True)
+        self.progress_thread.start()
+        
+        # 创建线程池，每个任务对应一个future，失败的任务重新提交
+        executor = ThreadPoolExecutor(max_workers=self.threads)
         start_time = time.time()
-        
-        # 启动所有下载线程
-        for i in range(self.threads):
-            thread = threading.Thread(target=self._download_chunk, args=(i,))
-            threads.append(thread)
-            thread.daemon = True
-            thread.start()
-        
-        # 等待任务队列完成
-        while not self.is_completed and any(t.is_alive() for t in threads):
-            time.sleep(1)
-            # 检查是否所有线程都已停止但任务未完成
-            with self.lock:
-                active_threads = sum(1 for status in self.thread_status.values() if status == 'running')
-                if active_threads == 0 and not self.task_queue.empty():
-                    print("所有线程都已停止，但任务未完成，尝试重新启动线程...")
-                    # 尝试重新启动一些线程
-                    for i in range(min(5, self.threads)):  # 重新启动最多5个线程
-                        thread = threading.Thread(target=self._download_chunk, args=(i + 100,))  # 使用新的线程ID
-                        threads.append(thread)
-                        thread.daemon = True
-                        thread.start()
+        try:
+            futures = {self._submit_task(executor, task): task for task in self.tasks}
+            retries = collections.Counter()
+            # 等待重试的任务，元素为(可以重新提交的时间, task)，在这里等待而不是在线程池中，
+            # 等待重试的任务不会占用线程，也不会在下载结束后再发出请求
+            delayed = []
+            result = True
+            
+            # 每完成一个任务或有任务到了重试时间就被唤醒一次，不需要轮询
+            while (futures or delayed) and not self.is_completed:
+                now = time.monotonic()
+                while delayed and delayed[0][0] <= now:
+                    task = heapq.heappop(delayed)[1]
+                    futures[self._submit_task(executor, task)] = task
+                timeout = delayed[0][0] - now if delayed else None
+                if not futures:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = futures.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        # 同一批中的其他任务已经结束了下载，不再重试
+                        if self.is_completed:
+                            break
+                        task_id = task[2]
+                        retries[task_id] += 1
+                        if retries[task_id] > self.max_retries:
+                            logger.error("任务 %d 重试 %d 次后仍然失败: %s", task_id, self.max_retries, e)
+                            result = False
+                            self.is_completed = True
+                            break
+                        # 指数退避加随机抖动，避免所有失败的任务同时重试，再次压垮服务器
+                        delay = min(30.0, 0.2 * 2 ** retries[task_id]) + random.random() * 0.5
+                        logger.warning("任务 %d 下载失败，%.1f 秒后第 %d 次重试: %s", task_id, delay, retries[task_id], e)
+                        heapq.heappush(delayed, (time.monotonic() + delay, task))
+        except BaseException:
+            # Ctrl+C或其他异常打断了等待，线程池的线程不是守护线程，会拖住解释器退出，
+            # 设置完成标志让正在进行的任务在下一次读取后退出，尚未开始的任务直接取消
+            self.is_completed = True
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        
+        # 所有任务都已写入输出文件才算成功
+        result = result and not self.ranges_ignored
         
         # 设置完成标志
         self.is_completed = True
+        # 取消尚未开始的任务，等正在进行的任务退出，保证所有文件描述符都已关闭
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        # 等待进度汇总线程完成最后一次刷新
+        self.progress_thread.join()
         
         # 关闭进度条
         if self.progress_bar:
             self.progress_bar.close()
         
-        # 合并文件
-        result = self._merge_parts()
+        if self.ranges_ignored:
+            return self._fallback_to_single_thread("服务器不支持分段下载")
+        
+        if result:
+            logger.info("文件 %s 下载完成!", self.file_name)
+        else:
+            logger.error("文件 %s 下载未完成", self.file_name)
         
         end_time = time.time()
-        print(f"下载耗时: {end_time - start_time:.2f} 秒")
+        logger.info("下载耗时: %.2f 秒", end_time - start_time)
         if end_time - start_time > 0:
-            print(f"下载速度: {self.file_size / (1024*1024 * (end_time - start_time)):.2f} MB/s")
+            logger.info("下载速度: %.2f MB/s", self.file_size / (1024*1024 * (end_time - start_time)))
         
-        if self.gui_progress_var:
-            self.gui_progress_var.set(100)
+        if self.progress_queue:
+            self.progress_queue.put(100)
         
         return result
     
+    def _fallback_to_single_thread(self, reason):
+        """无法多线程下载时改用单线程下载
+        参数:
+            reason (str): 改用单线程下载的原因
+        """
+        logger.info("%s，尝试单线程下载...", reason)
+        result = self._single_thread_download()
+        if self.progress_queue:
+            self.progress_queue.put(100)
+        return result
+    
     def _single_thread_download(self):
         """单线程下载作为备选方案"""
         try:
-            response = requests.get(self.url, stream=True, timeout=self.timeout)
-            with open(self.file_name, 'wb') as f:
-                total_size = 0
-                last_activity_time = time.time()
-                for chunk in response.iter_content(chunk_size=self.chunk_size):
-                    if chunk:
-                        f.write(chunk)
-                        total_size += len(chunk)
-                        with self.lock:
-                            self.completed += len(chunk)
-                        if self.progress_bar:
-                            self.progress_bar.update(len(chunk))
-                        if self.gui_progress_var:
-                            # 因为不知道总大小，所以这里不更新百分比
-                            pass
-                        sys.stdout.write(f'\r下载进度: {total_size / (1024*1024):.2f} MB')
-                        sys.stdout.flush()
-                        # 更新最后活动时间
-                        last_activity_time = time.time()
-                    # 检查是否超时
-                    if time.time() - last_activity_time > self.timeout:
-                        print("\n单线程下载超时")
-                        return False
-            print(f"\n文件 {self.file_name} 单线程下载完成!")
+            with self.session.get(self.url, stream=True, timeout=self.timeout) as response:
+                response.raw.decode_content = True
+                with open(self.file_name, 'wb') as f:
+                    # 拷贝循环交给copyfileobj，进度由单独的线程定期读取文件位置来显示
+                    done = threading.Event()
+                    reporter = threading.Thread(target=self._report_single_thread_progress, args=(f, done), daemon=True)
+                    reporter.start()
+                    try:
+                        shutil.copyfileobj(response.raw, f, self.chunk_size)
+                    finally:
+                        done.set()
+                        reporter.join()
+            logger.info("文件 %s 单线程下载完成!", self.file_name)
             return True
         except Exception as e:
-            print(f"单线程下载失败: {e}")
+            logger.error("单线程下载失败: %s", e)
             return False
+    
+    def _report_single_thread_progress(self, f, done):
+        """单线程下载时定期显示已下载的大小
+        参数:
+            f: 正在写入的输出文件
+            done (threading.Event): 下载结束时被设置
+        """
+        while True:
+            finished = done.wait(0.5)
+            self.completed = f.tell()
+            sys.stdout.write(f'\r下载进度: {self.completed / (1024*1024):.2f} MB')
+            sys.stdout.flush()
+            if finished:
+                print()
+                break
 
 class DownloaderGUI:
     def __init__(self, root):
@@ -398,14 +575,14 @@ class DownloaderGUI:
                 return True  # 允许为空
             try:
                 num = int(new_value)
-                return num > 0 and num <= 10000  # 限制线程数在1-10000之间
+                return num > 0 and num <= MAX_THREADS  # 限制线程数在1-MAX_THREADS之间
             except ValueError:
                 return False
         
         vcmd = threads_frame.register(validate_threads)
         threads_entry.config(validate="key", validatecommand=(vcmd, '%P'))
         
-        ttk.Label(threads_frame, text="(1-10000之间的整数)", font=self.font).pack(anchor=tk.W, pady=(2, 0))
+        ttk.Label(threads_frame, text=f"(1-{MAX_THREADS}之间的整数)", font=self.font).pack(anchor=tk.W, pady=(2, 0))
         
         # 进度条
         self.progress_var = tk.DoubleVar()
@@ -423,7 +600,7 @@ class DownloaderGUI:
         start_btn = ttk.Button(btn_frame, text="开始下载", command=self.start_download)
         start_btn.pack(side=tk.LEFT, padx=(0, 10))
         
-        exit_btn = ttk.Button(btn_frame, text="退出", command=root.destroy)
+        exit_btn = ttk.Button(btn_frame, text="退出", command=self.exit)
         exit_btn.pack(side=tk.RIGHT)
         
         # 底部提示
@@ -433,6 +610,47 @@ class DownloaderGUI:
         tips = "提示: 包含特殊字符的URL可以直接粘贴到输入框中，无需额外处理"
         ttk.Label(tips_frame, text=tips, font=self.font, foreground="gray").pack(anchor=tk.W)
         
+        # 下载线程不直接操作Tk控件，而是把进度和界面操作放入队列，由Tk主线程定时取出执行
+        self.progress_queue = queue.Queue()
+        self.ui_queue = queue.Queue()
+        self.root.after(100, self.process_queues)
+        # 正在进行的下载，退出时通知它们停止
+        self.downloaders = set()
+        # 点窗口的关闭按钮和点退出按钮一样处理
+        self.root.protocol('WM_DELETE_WINDOW', self.exit)
+        
+    def exit(self):
+        """停止正在进行的下载并关闭窗口
+        下载线程池中的线程不是守护线程，不通知它们停止的话，窗口关闭后进程仍会在后台把文件下载完
+        """
+        for downloader in list(self.downloaders):
+            downloader.is_completed = True
+        self.root.destroy()
+        
+    def run_in_ui(self, func, *args, **kwargs):
+        """供下载线程调用，把对Tk控件的操作交给Tk主线程执行"""
+        self.ui_queue.put(functools.partial(func, *args, **kwargs))
+    
+    def process_queues(self):
+        """取出下载线程放入队列的进度和界面操作，进度只用最新的值更新"""
+        try:
+            percentage = None
+            try:
+                while True:
+                    percentage = self.progress_queue.get_nowait()
+            except queue.Empty:
+                pass
+            if percentage is not None:
+                self.progress_var.set(percentage)
+            try:
+                while True:
+                    self.ui_queue.get_nowait()()
+            except queue.Empty:
+                pass
+        finally:
+            # 某个操作出错（例如窗口正在关闭时的TclError）也要继续轮询，否则进度和对话框都不会再更新
+            self.root.after(100, self.process_queues)
+    
     def browse_dir(self):
         """浏览目录"""
         dir_name = filedialog.askdirectory(initialdir=self.dir_var.get())
@@ -443,13 +661,8 @@ class DownloaderGUI:
         """浏览文件"""
         default_filename = ""
         if self.url_var.get():
-            # 尝试从URL提取文件名
-            try:
-                import re
-                url = self.url_var.get()
-                default_filename = re.findall(r'[^/]+$', url.split('?')[0])[0]
-            except:
-                default_filename = ""
+            # 从URL提取文件名，与下载时使用的默认文件名一致
+            default_filename = file_name_from_url(self.url_var.get())
         
         filename = filedialog.asksaveasfilename(defaultextension="", 
                                                filetypes=[("所有文件", "*.*")],
@@ -488,8 +701,8 @@ class DownloaderGUI:
         
         try:
             threads = int(threads_text)
-            if threads <= 0 or threads > 10000:
-                messagebox.showerror("错误", "线程数必须在1-10000之间")
+            if threads <= 0 or threads > MAX_THREADS:
+                messagebox.showerror("错误", f"线程数必须在1-{MAX_THREADS}之间")
                 return
         except ValueError:
             messagebox.showerror("错误", "请输入有效的线程数")
@@ -497,23 +710,27 @@ class DownloaderGUI:
         
         # 在新线程中开始下载，避免UI冻结
         def download_thread_func():
-            self.progress_var.set(0)
-            self.progress_label.config(text="正在准备下载...")
+            self.progress_queue.put(0)
+            self.run_in_ui(self.progress_label.config, text="正在准备下载...")
             
             try:
                 # 使用默认超时60秒
                 downloader = MultiThreadDownloader(url, file_name, threads, save_dir=save_dir, timeout=60)
-                result = downloader.download(self.progress_var)
+                self.downloaders.add(downloader)
+                try:
+                    result = downloader.download(self.progress_queue)
+                finally:
+                    self.downloaders.discard(downloader)
                 
                 if result:
-                    self.progress_label.config(text="下载完成")
-                    messagebox.showinfo("成功", f"文件已成功下载到:\n{downloader.file_name}")
+                    self.run_in_ui(self.progress_label.config, text="下载完成")
+                    self.run_in_ui(messagebox.showinfo, "成功", f"文件已成功下载到:\n{downloader.file_name}")
                 else:
-                    self.progress_label.config(text="下载失败")
-                    messagebox.showerror("失败", "下载过程中出现错误")
+                    self.run_in_ui(self.progress_label.config, text="下载失败")
+                    self.run_in_ui(messagebox.showerror, "失败", "下载过程中出现错误")
             except Exception as e:
-                self.progress_label.config(text=f"下载失败: {str(e)}")
-                messagebox.showerror("错误", f"下载过程中出现异常:\n{str(e)}")
+                self.run_in_ui(self.progress_label.config, text=f"下载失败: {str(e)}")
+                self.run_in_ui(messagebox.showerror, "错误", f"下载过程中出现异常:\n{str(e)}")
         
         threading.Thread(target=download_thread_func, daemon=True).start()
 
@@ -531,9 +748,12 @@ def main():
     parser.add_argument('-t', '--threads', type=int, default=10, help='线程数，默认10')
     parser.add_argument('-c', '--chunk', type=int, default=1024*1024, help='块大小，默认1MB')
     parser.add_argument('--nogui', action='store_true', help='不使用GUI界面，强制使用命令行模式')
+    parser.add_argument('-v', '--verbose', action='store_true', help='输出每个任务的调试信息')
     
     args, unknown = parser.parse_known_args()
     
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(message)s')
+    
     # 如果指定了--nogui或提供了URL参数，则使用命令行模式
     if args.nogui or args.url:
         # 处理特殊情况：当URL被截断时尝试从剩余参数中恢复
@@ -546,7 +766,7 @@ def main():
                     break
                 full_url += ' ' + arg
             args.url = full_url
-            print(f"检测到并修复了URL: {args.url}")
+            logger.info("检测到并修复了URL: %s", args.url)
         
         if not args.url:
             parser.error("命令行模式需要提供URL参数 (-u/--url)")